@@ -13,20 +13,16 @@ import argparse
 import json
 import os.path
 import platform
-import subprocess
 import sys
 
+# Import the sibling script directly (instead of through `cupyx.tools`) so
+# that this tool keeps working without CuPy.
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import install_library  # NOQA
 
-def _get_records(library: str, cuda: str):
-    command = [
-        sys.executable,
-        'install_library.py',
-        '--library', library,
-        '--cuda', cuda,
-        '--action', 'dump',
-    ]
-    return json.loads(
-        subprocess.check_output(command, cwd=os.path.dirname(__file__)))
+
+def _get_records(library: str):
+    return install_library.library_records[library]
 
 
 def _generate_wheel_metadata(cuda_version, target_system, libraries):
@@ -35,7 +31,7 @@ def _generate_wheel_metadata(cuda_version, target_system, libraries):
         'packaging': 'pip',
     }
     for library in libraries:
-        for record in _get_records(library, cuda_version):
+        for record in _get_records(library):
             if record['cuda'] == cuda_version:
                 version = record[library]
                 min_pypi_version = record.get('min_pypi_version', version)
@@ -1,8 +1,10 @@
 import argparse
 import contextlib
+import functools
 import time
 
 import cupy
+import cupyx
 import matplotlib.pyplot as plt
 import numpy
 
@@ -17,23 +19,238 @@ def timer(message):
     print('%s:  %f sec' % (message, end - start))
 
 
-var_kernel = cupy.ElementwiseKernel(
-    'T x0, T x1, T c0, T c1', 'T out',
-    'out = (x0 - c0) * (x0 - c0) + (x1 - c1) * (x1 - c1)',
-    'var_kernel'
-)
-sum_kernel = cupy.ReductionKernel(
-    'T x, S mask', 'T out',
-    'mask ? x : 0',
-    'a + b', 'out = a', '0',
-    'sum_kernel'
-)
-count_kernel = cupy.ReductionKernel(
-    'T mask', 'float32 out',
-    'mask ? 1.0 : 0.0',
-    'a + b', 'out = a', '0.0',
-    'count_kernel'
-)
+# Size in bytes of the CPU cache that a block of samples should fit in.
+cpu_cache_size = 1 << 20
+
+# Maximum number of centroid elements (n_clusters * n_dim) that can be held in
+# constant memory (32 KiB of the 64 KiB available).
+max_constant_centers = 8192
+
+# Maximum number of centroid elements loaded into shared memory at a time,
+# and number of samples processed by each thread, when the centroids are too
+# large for constant memory.
+center_tile_size = 2048
+rows_per_thread = 4
+
+l2nn_source = r'''
+// The samples are stored feature-major, i.e. the d-th feature of the i-th
+// sample is x[d * n_samples + i], so that consecutive threads read
+// consecutive addresses.  The offset is computed in 64 bits, as it can
+// exceed the range of int for a large number of samples and features.  The
+// number of clusters and features are compile-time constants so that the
+// loops over them can be fully unrolled.
+
+#if N_CLUSTERS * N_DIM <= MAX_CENTERS
+
+// The centroids are read uniformly by all threads in a warp, which is the
+// access pattern the constant cache is optimized for.
+__constant__ float c_centers[N_CLUSTERS * N_DIM];
+
+extern "C" __global__
+void fused_l2nn(const float* x, int n_samples, int* pred, int* changed) {
+    int i = blockIdx.x * blockDim.x + threadIdx.x;
+    if (i >= n_samples) {
+        return;
+    }
+    int best_k = 0;
+    float best_dist = 0.0f;
+    #pragma unroll
+    for (int k = 0; k < N_CLUSTERS; ++k) {
+        float dist = 0.0f;
+        #pragma unroll
+        for (int d = 0; d < N_DIM; ++d) {
+            float diff =
+                x[(long long)d * n_samples + i] - c_centers[k * N_DIM + d];
+            dist += diff * diff;
+        }
+        if (k == 0 || dist < best_dist) {
+            best_dist = dist;
+            best_k = k;
+        }
+    }
+    // Update the label in place and raise the flag if it has been changed,
+    // so that the convergence test only has to read back a single integer.
+    if (pred[i] != best_k) {
+        pred[i] = best_k;
+        *changed = 1;
+    }
+}
+
+#if N_CLUSTERS == 2
+// Specialization of fused_l2nn for two clusters: the nearest centroid is
+// chosen with a single branchless comparison and the labels are bytes.
+extern "C" __global__
+void fused_l2nn_k2(const float* x, int n_samples, unsigned char* pred,
+                   int* changed) {
+    int i = blockIdx.x * blockDim.x + threadIdx.x;
+    if (i >= n_samples) {
+        return;
+    }
+    float dist0 = 0.0f;
+    float dist1 = 0.0f;
+    #pragma unroll
+    for (int d = 0; d < N_DIM; ++d) {
+        float xd = x[(long long)d * n_samples + i];
+        float diff0 = xd - c_centers[d];
+        float diff1 = xd - c_centers[N_DIM + d];
+        dist0 += diff0 * diff0;
+        dist1 += diff1 * diff1;
+    }
+    unsigned char label = dist1 < dist0;
+    if (pred[i] != label) {
+        pred[i] = label;
+        *changed = 1;
+    }
+}
+#endif
+
+// Same as fused_l2nn, but each thread handles four consecutive samples whose
+// features are loaded with a single float4 read through the read-only cache.
+// Requires n_samples to be a multiple of 4 so that every feature row of x is
+// 16-byte aligned.
+extern "C" __global__
+void fused_l2nn_vec4(const float* x, int n_samples, int* pred, int* changed) {
+    int n_vec = n_samples / 4;
+    int t = blockIdx.x * blockDim.x + threadIdx.x;
+    if (t >= n_vec) {
+        return;
+    }
+    const float4* x4 = reinterpret_cast<const float4*>(x);
+    int best_k[4] = {0, 0, 0, 0};
+    float best_dist[4] = {0.0f, 0.0f, 0.0f, 0.0f};
+    #pragma unroll
+    for (int k = 0; k < N_CLUSTERS; ++k) {
+        float dist[4] = {0.0f, 0.0f, 0.0f, 0.0f};
+        #pragma unroll
+        for (int d = 0; d < N_DIM; ++d) {
+            float4 xv = __ldg(&x4[(long long)d * n_vec + t]);
+            float c = c_centers[k * N_DIM + d];
+            float diff;
+            diff = xv.x - c;
+            dist[0] += diff * diff;
+            diff = xv.y - c;
+            dist[1] += diff * diff;
+            diff = xv.z - c;
+            dist[2] += diff * diff;
+            diff = xv.w - c;
+            dist[3] += diff * diff;
+        }
+        #pragma unroll
+        for (int r = 0; r < 4; ++r) {
+            if (k == 0 || dist[r] < best_dist[r]) {
+                best_dist[r] = dist[r];
+                best_k[r] = k;
+            }
+        }
+    }
+    #pragma unroll
+    for (int r = 0; r < 4; ++r) {
+        int i = t * 4 + r;
+        if (pred[i] != best_k[r]) {
+            pred[i] = best_k[r];
+            *changed = 1;
+        }
+    }
+}
+
+#else
+
+// Same as fused_l2nn, but for centroids that do not fit in constant memory.
+// The block loads tiles of TILE_CLUSTERS centroids times TILE_DIM features
+// into shared memory, and each thread reuses every loaded centroid element
+// for ROWS_PER_THREAD samples whose partial distances are kept in registers.
+// Either a tile holds whole centroids (TILE_DIM == N_DIM), or it holds a
+// chunk of the features of a single centroid (TILE_CLUSTERS == 1), in which
+// case the partial distances are carried over to the next chunk.
+extern "C" __global__
+void fused_l2nn_tiled(const float* x, const float* centers, int n_samples,
+                      int* pred, int* changed) {
+    __shared__ float s_centers[TILE_CLUSTERS * TILE_DIM];
+    // The samples of a thread are blockDim.x apart so that the loads of a
+    // warp stay coalesced.
+    int base = blockIdx.x * blockDim.x * ROWS_PER_THREAD + threadIdx.x;
+    int best_k[ROWS_PER_THREAD];
+    float best_dist[ROWS_PER_THREAD];
+    float dist[ROWS_PER_THREAD];
+    #pragma unroll
+    for (int r = 0; r < ROWS_PER_THREAD; ++r) {
+        best_k[r] = 0;
+        best_dist[r] = __int_as_float(0x7f800000);  // +inf
+    }
+
+    for (int k0 = 0; k0 < N_CLUSTERS; k0 += TILE_CLUSTERS) {
+        int k1 = min(k0 + TILE_CLUSTERS, N_CLUSTERS);
+        for (int d0 = 0; d0 < N_DIM; d0 += TILE_DIM) {
+            int d1 = min(d0 + TILE_DIM, N_DIM);
+            __syncthreads();
+            for (int j = threadIdx.x; j < (k1 - k0) * TILE_DIM;
+                 j += blockDim.x) {
+                int d = d0 + j % TILE_DIM;
+                if (d < d1) {
+                    s_centers[j] = centers[(k0 + j / TILE_DIM) * N_DIM + d];
+                }
+            }
+            __syncthreads();
+
+            for (int k = k0; k < k1; ++k) {
+                const float* c = &s_centers[(k - k0) * TILE_DIM];
+                if (d0 == 0) {
+                    #pragma unroll
+                    for (int r = 0; r < ROWS_PER_THREAD; ++r) {
+                        dist[r] = 0.0f;
+                    }
+                }
+                for (int d = d0; d < d1; ++d) {
+                    float cd = c[d - d0];
+                    #pragma unroll
+                    for (int r = 0; r < ROWS_PER_THREAD; ++r) {
+                        // Threads past the end still have to take part in the
+                        // tile loads, so they compute on the last sample
+                        // instead and their results are discarded.
+                        int i = min(base + r * blockDim.x, n_samples - 1);
+                        float diff = x[(long long)d * n_samples + i] - cd;
+                        dist[r] += diff * diff;
+                    }
+                }
+                if (d1 == N_DIM) {
+                    #pragma unroll
+                    for (int r = 0; r < ROWS_PER_THREAD; ++r) {
+                        if (dist[r] < best_dist[r]) {
+                            best_dist[r] = dist[r];
+                            best_k[r] = k;
+                        }
+                    }
+                }
+            }
+        }
+    }
+
+    #pragma unroll
+    for (int r = 0; r < ROWS_PER_THREAD; ++r) {
+        int i = base + r * blockDim.x;
+        if (i < n_samples && pred[i] != best_k[r]) {
+            pred[i] = best_k[r];
+            *changed = 1;
+        }
+    }
+}
+
+#endif
+'''
+
+
+@functools.lru_cache()
+def get_l2nn_module(n_clusters, n_dim):
+    # Specialize the kernels for the given shape of the centroids.
+    defines = f'''
+#define N_CLUSTERS {n_clusters}
+#define N_DIM {n_dim}
+#define MAX_CENTERS {max_constant_centers}
+#define TILE_CLUSTERS {max(1, center_tile_size // n_dim)}
+#define TILE_DIM {min(n_dim, center_tile_size)}
+#define ROWS_PER_THREAD {rows_per_thread}
+'''
+    return cupy.RawModule(code=defines + l2nn_source)
 
 
 def fit_xp(X, n_clusters, max_iter):
@@ -46,29 +263,54 @@ def fit_xp(X, n_clusters, max_iter):
 
     # Make an array to store the labels indicating which cluster each sample is
     # contained.
-    pred = xp.zeros(n_samples)
+    pred = xp.zeros(n_samples, dtype=xp.int64)
 
     # Choose the initial centroid for each cluster.
     initial_indexes = xp.random.choice(n_samples, n_clusters, replace=False)
     centers = X[initial_indexes]
 
+    # On CPU, the distances are computed for a block of samples at a time so
+    # that the block and its distances stay in the cache.  On GPU, all samples
+    # are processed at once to keep the number of kernel launches small.
+    if xp is numpy:
+        block_size = max(1, cpu_cache_size // (
+            (n_clusters + X.shape[1]) * X.itemsize))
+    else:
+        block_size = n_samples
+
+    # Allocate the work buffers once and reuse them in every iteration.
+    new_pred = xp.empty_like(pred)
+    distances = xp.empty(
+        (min(block_size, n_samples), n_clusters), dtype=X.dtype)
+    sums = xp.empty((n_clusters, X.shape[1]), dtype=X.dtype)
+
     for _ in range(max_iter):
-        # Compute the new label for each sample.
-        distances = xp.linalg.norm(X[:, None, :] - centers[None, :, :], axis=2)
-        new_pred = xp.argmin(distances, axis=1)
+        # Compute the new label for each sample.  The squared distance is
+        # expanded as ||x||^2 + ||c||^2 - 2 x.c so that the dominant term is a
+        # single matrix product instead of an (n_samples, n_clusters, n_dim)
+        # temporary.  ||x||^2 is constant for each sample and does not affect
+        # argmin, so it is omitted.
+        c2 = (centers * centers).sum(axis=1)
+        for start in range(0, n_samples, block_size):
+            stop = min(start + block_size, n_samples)
+            block = distances[:stop - start]
+            xp.matmul(X[start:stop], centers.T, out=block)
+            block *= -2
+            block += c2[None, :]
+            xp.argmin(block, axis=1, out=new_pred[start:stop])
 
         # If the label is not changed for each sample, we suppose the
         # algorithm has converged and exit from the loop.
         if xp.all(new_pred == pred):
             break
-        pred = new_pred
+        pred, new_pred = new_pred, pred
 
-        # Compute the new centroid for each cluster.
-        i = xp.arange(n_clusters)
-        mask = pred == i[:, None]
-        sums = xp.where(mask[:, :, None], X, 0).sum(axis=1)
-        counts = xp.count_nonzero(mask, axis=1).reshape((n_clusters, 1))
-        centers = sums / counts
+        # Compute the new centroid for each cluster by scattering every sample
+        # into the sum of its cluster in a single pass.
+        sums.fill(0)
+        xp.add.at(sums, pred, X)
+        counts = xp.bincount(pred, minlength=n_clusters)
+        xp.divide(sums, counts[:, None], out=centers)
 
     return centers, pred
 
@@ -76,26 +318,101 @@ def fit_xp(X, n_clusters, max_iter):
 def fit_custom(X, n_clusters, max_iter):
     assert X.ndim == 2
 
-    n_samples = len(X)
+    # The work is issued on a non-blocking stream, as capturing a CUDA graph
+    # is not possible on the default stream.
+    stream = cupy.cuda.Stream(non_blocking=True)
+    with stream:
+        centers, pred = _fit_custom(X, n_clusters, max_iter, stream)
+    stream.synchronize()
+    return centers, pred
+
 
-    pred = cupy.zeros(n_samples)
+def _fit_custom(X, n_clusters, max_iter, stream):
+    X = cupy.ascontiguousarray(X, dtype=cupy.float32)
+    n_samples, n_dim = X.shape
+
+    # The distance kernels read the samples in feature-major order.
+    X_soa = cupy.ascontiguousarray(X.T)
 
     initial_indexes = cupy.random.choice(n_samples, n_clusters, replace=False)
     centers = X[initial_indexes]
 
+    # Keep the centroids in constant memory if they fit, and otherwise stream
+    # them through shared memory in tiles.
+    use_constant = n_clusters * n_dim <= max_constant_centers
+    if use_constant and n_clusters == 2:
+        # Two labels fit in a byte, which reduces the memory traffic of the
+        # labels read and written in every iteration.
+        pred = cupy.zeros(n_samples, dtype=cupy.uint8)
+    else:
+        pred = cupy.zeros(n_samples, dtype=cupy.int32)
+
+    # Allocate the work buffers once and reuse them in every iteration.
+    changed = cupy.empty((), dtype=cupy.int32)
+    cluster_ids = cupy.arange(n_clusters, dtype=cupy.int32)
+    sums = cupy.empty((n_clusters, n_dim), dtype=cupy.float64)
+
+    l2nn_module = get_l2nn_module(n_clusters, n_dim)
+    threads = 256
+    if not use_constant:
+        fused_l2nn = l2nn_module.get_function('fused_l2nn_tiled')
+        rows_per_block = threads * rows_per_thread
+        blocks = (n_samples + rows_per_block - 1) // rows_per_block
+        args = (X_soa, centers, numpy.int32(n_samples), pred, changed)
+    else:
+        c_centers = l2nn_module.get_global('c_centers')
+        if n_clusters == 2:
+            fused_l2nn = l2nn_module.get_function('fused_l2nn_k2')
+            blocks = (n_samples + threads - 1) // threads
+        elif n_samples % 4 == 0:
+            fused_l2nn = l2nn_module.get_function('fused_l2nn_vec4')
+            blocks = (n_samples // 4 + threads - 1) // threads
+        else:
+            fused_l2nn = l2nn_module.get_function('fused_l2nn')
+            blocks = (n_samples + threads - 1) // threads
+        args = (X_soa, numpy.int32(n_samples), pred, changed)
+
+    # Compute the nearest centroid of each sample in a single kernel so that
+    # the (n_samples, n_clusters) distance matrix is never stored.
+    def assign():
+        changed.fill(0)
+        if use_constant:
+            c_centers.copy_from_device_async(
+                centers.data, centers.nbytes, stream)
+        fused_l2nn((blocks,), (threads,), args)
+
+    # The assignment step always runs the same operations on the same
+    # buffers, so it is captured once into a CUDA graph which is replayed in
+    # every iteration.  The centroid update stays outside of the graph because
+    # the Thrust sort synchronizes the stream, which is not allowed during
+    # capture.  Stream capture is not supported on HIP.
+    assign_graph = None
+    if not cupy.cuda.runtime.is_hip:
+        stream.begin_capture()
+        assign()
+        assign_graph = stream.end_capture()
+
     for _ in range(max_iter):
-        distances = var_kernel(X[:, None, 0], X[:, None, 1],
-                               centers[None, :, 1], centers[None, :, 0])
-        new_pred = cupy.argmin(distances, axis=1)
-        if cupy.all(new_pred == pred):
+        if assign_graph is None:
+            assign()
+        else:
+            assign_graph.launch(stream)
+        if not changed:
             break
-        pred = new_pred
 
-        i = cupy.arange(n_clusters)
-        mask = pred == i[:, None]
-        sums = sum_kernel(X, mask[:, :, None], axis=1)
-        counts = count_kernel(mask, axis=1).reshape((n_clusters, 1))
-        centers = sums / counts
+        # Compute the new centroids by sorting the samples by label and
+        # reducing each contiguous segment, which needs neither per-cluster
+        # masks nor atomic operations.  The segmented sum is accumulated in
+        # float64 so that it stays accurate for a large number of samples.
+        # The centroids are updated in place, as the graph refers to them.
+        order = cupy.argsort(pred)
+        offsets = cupy.searchsorted(pred[order], cluster_ids)
+        cupy.add.reduceat(
+            X[order], offsets, axis=0, dtype=cupy.float64, out=sums)
+        counts = cupy.diff(offsets, append=n_samples).reshape((n_clusters, 1))
+        # reduceat does not give zero for an empty segment, so a cluster that
+        # has lost all of its samples keeps its previous centroid instead.
+        cupy.copyto(centers, sums / counts, where=counts > 0)
 
     return centers, pred
 
@@ -112,14 +429,28 @@ def draw(X, n_clusters, centers, pred, output):
 
 
 def run(gpuid, n_clusters, num, max_iter, use_custom_kernel, output):
-    samples = numpy.random.randn(num, 2)
+    # Use single precision, as double-precision throughput is only a small
+    # fraction of single-precision throughput on most GPUs.
+    samples = numpy.random.randn(num, 2).astype(numpy.float32)
     X_train = numpy.r_[samples + 1, samples - 1]
 
     with timer(' CPU '):
         centers, pred = fit_xp(X_train, n_clusters, max_iter)
 
     with cupy.cuda.Device(gpuid):
-        X_train = cupy.asarray(X_train)
+        # Transfer the samples from pinned memory on a non-blocking stream so
+        # that the copy runs at full bandwidth and overlaps with the host
+        # work below.
+        X_pinned = cupyx.empty_like_pinned(X_train)
+        X_pinned[...] = X_train
+        stream = cupy.cuda.Stream(non_blocking=True)
+        X_train = cupy.empty(X_pinned.shape, X_pinned.dtype)
+        X_train.set(X_pinned, stream=stream)
+
+        if output is not None:
+            index = numpy.random.choice(
+                len(X_train), min(300, len(X_train)), replace=False)
+        stream.synchronize()
 
         with timer(' GPU '):
             if use_custom_kernel:
@@ -128,7 +459,6 @@ def run(gpuid, n_clusters, num, max_iter, use_custom_kernel, output):
                 centers, pred = fit_xp(X_train, n_clusters, max_iter)
 
         if output is not None:
-            index = numpy.random.choice(10000000, 300, replace=False)
             draw(X_train[index].get(), n_clusters, centers.get(),
                  pred[index].get(), output)
 
@@ -144,7 +474,7 @@ if __name__ == '__main__':
     parser.add_argument('--max-iter', '-m', default=10, type=int,
                         help='number of iterations')
     parser.add_argument('--use-custom-kernel', action='store_true',
-                        default=False, help='use Elementwise kernel')
+                        default=False, help='use custom kernels')
     parser.add_argument('--output-image', '-o', default=None, type=str,
                         help='output image file name')
     args = parser.parse_args()